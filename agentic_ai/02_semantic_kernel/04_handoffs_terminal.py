@@ -1,6 +1,9 @@
 # Copyright (c) Microsoft. All rights reserved.
 import os
+import time
 import asyncio
+import asyncpg
+from typing import Dict, List, Optional, Set, Tuple
 from dotenv import load_dotenv
 
 from semantic_kernel.agents import Agent, ChatCompletionAgent, HandoffOrchestration, OrchestrationHandoffs
@@ -16,31 +19,223 @@ AZURE_DEPLOYMENT_NAME=os.getenv("AZURE_DEPLOYMENT_NAME")
 AZURE_OPENAI_ENDPOINT=os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_API_KEY=os.getenv("AZURE_OPENAI_API_KEY")
 
+# PostgreSQL 接続情報（MCP サーバと同じ orders / order_details / inventory スキーマを参照）
+PG_CONFIG = {
+    "user": os.getenv("PG_USER"),
+    "password": os.getenv("PG_PASS"),
+    "database": os.getenv("PG_DB"),
+    "host": os.getenv("PG_HOST"),
+    "port": int(os.getenv("PGPORT", 5432)),
+}
+# MCP サーバのプール設定（PG_POOL_MAX_SIZE）とは別に、このサンプル専用の変数で指定
+ORDER_PG_POOL_MIN_SIZE = int(os.getenv("ORDER_PG_POOL_MIN_SIZE", 1))
+ORDER_PG_POOL_MAX_SIZE = int(os.getenv("ORDER_PG_POOL_MAX_SIZE", 5))
+# 注文情報キャッシュの有効期間（秒）
+ORDER_CACHE_TTL = float(os.getenv("ORDER_CACHE_TTL", 30))
+
+ORDER_SQL = """
+    SELECT
+        o.order_id,
+        o.user_id,
+        o.order_date,
+        od.product_id,
+        p.product_name,
+        od.quantity,
+        od.price,
+        i.stock
+    FROM orders o
+    LEFT JOIN order_details od ON od.order_id = o.order_id
+    LEFT JOIN products p ON p.product_id = od.product_id
+    LEFT JOIN inventory i ON i.product_id = od.product_id
+    WHERE o.order_id = ANY($1::int[])
+    ORDER BY o.order_id, od.product_id
+"""
+
+
+class OrderRepository:
+    """注文情報を PostgreSQL から取得する共有リポジトリ。
+
+    全プラグインで 1 つのコネクションプールを共有し、取得結果は短い TTL でキャッシュします。
+    同じ注文 ID への同時リクエストは 1 回のクエリにまとめ、異なる注文 ID も
+    同じイベントループの周回で要求されたものは 1 回のクエリで一括取得します。
+    """
+
+    def __init__(self, pg_config: dict, ttl: float = ORDER_CACHE_TTL):
+        self._pg_config = pg_config
+        self._ttl = ttl
+        self._pool: Optional[asyncpg.Pool] = None
+        self._pool_lock = asyncio.Lock()
+        self._cache: Dict[int, Tuple[float, Optional[dict]]] = {}
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self._pending: List[int] = []
+        self._flush_tasks: Set[asyncio.Task] = set()
+
+    async def get_pool(self) -> asyncpg.Pool:
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        min_size=ORDER_PG_POOL_MIN_SIZE,
+                        max_size=ORDER_PG_POOL_MAX_SIZE,
+                        **self._pg_config,
+                    )
+        return self._pool
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def get_order(self, order_id: int) -> Optional[dict]:
+        """注文と明細を取得します。存在しない場合は None を返します。"""
+        cached = self._cache.get(order_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        future = self._inflight.get(order_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._inflight[order_id] = future
+            if not self._pending:
+                # 同じ周回で要求された注文 ID をまとめて 1 回で取得する
+                # （完了前にガベージコレクトされないようタスクの参照を保持）
+                task = loop.create_task(self._flush())
+                self._flush_tasks.add(task)
+                task.add_done_callback(self._flush_tasks.discard)
+            self._pending.append(order_id)
+        return await asyncio.shield(future)
+
+    async def _flush(self) -> None:
+        order_ids, self._pending = self._pending, []
+        try:
+            orders = await self._fetch(order_ids)
+        except Exception as e:
+            if len(order_ids) == 1:
+                self._resolve(order_ids[0], error=e)
+                return
+            # 一括取得に失敗した場合は 1 件ずつ再取得し、失敗した注文だけをエラーにする
+            for order_id in order_ids:
+                try:
+                    orders = await self._fetch([order_id])
+                except Exception as e:
+                    self._resolve(order_id, error=e)
+                else:
+                    self._resolve(order_id, orders.get(order_id))
+            return
+
+        for order_id in order_ids:
+            self._resolve(order_id, orders.get(order_id))
+
+    async def _fetch(self, order_ids: List[int]) -> Dict[int, dict]:
+        pool = await self.get_pool()
+        rows = await pool.fetch(ORDER_SQL, order_ids)
+
+        orders: Dict[int, dict] = {}
+        for r in rows:
+            order = orders.setdefault(r["order_id"], {
+                "order_id": r["order_id"],
+                "user_id": r["user_id"],
+                "order_date": r["order_date"],
+                "items": [],
+            })
+            if r["product_id"] is not None:
+                order["items"].append({
+                    "product_id": r["product_id"],
+                    "product_name": r["product_name"],
+                    "quantity": r["quantity"],
+                    "price": r["price"],
+                    "stock": r["stock"],
+                })
+        return orders
+
+    def _resolve(self, order_id: int, order: Optional[dict] = None, error: Optional[BaseException] = None) -> None:
+        future = self._inflight.pop(order_id)
+        if error is None:
+            # エラーはキャッシュせず、次回の問い合わせで再取得する
+            self._cache[order_id] = (time.monotonic() + self._ttl, order)
+        if not future.done():
+            if error is None:
+                future.set_result(order)
+            else:
+                future.set_exception(error)
+
+
+order_repository = OrderRepository(PG_CONFIG)
+
+# 注文情報の取得時に発生し得るデータベース・接続エラー
+DB_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
+
+
+# orders.order_id は INTEGER 列のため、範囲外の ID はクエリに含めない
+ORDER_ID_MAX = 2**31 - 1
+
+
+def parse_order_id(order_id: str) -> Optional[int]:
+    try:
+        oid = int(str(order_id).strip().lstrip("#"))
+    except ValueError:
+        return None
+    return oid if 1 <= oid <= ORDER_ID_MAX else None
+
+
+def order_total(order: dict) -> int:
+    return sum(item["quantity"] * item["price"] for item in order["items"])
+
+
+def format_items(order: dict) -> str:
+    return "、".join(f"{item['product_name']} x{item['quantity']}" for item in order["items"])
+
+
 # プラグインの作成
 class OrderStatusPlugin:
     @kernel_function
-    def check_order_status(self, order_id: str) -> str:
+    async def check_order_status(self, order_id: str) -> str:
         """注文の状況を確認します。"""
-        # 注文状況の確認をシミュレート
-        return f"注文 {order_id} は発送済みで、2-3日で到着予定です。"
+        oid = parse_order_id(order_id)
+        try:
+            order = await order_repository.get_order(oid) if oid is not None else None
+        except DB_ERRORS as e:
+            print(f"注文 {order_id} の取得に失敗しました: {e}")
+            return f"注文 {order_id} の情報を現在取得できません。時間をおいて再度お試しください。"
+        if order is None:
+            return f"注文 {order_id} は見つかりませんでした。"
+        return (
+            f"注文 {oid} は {order['order_date']} に受け付けられました。"
+            f"内容: {format_items(order)}（合計 {order_total(order)} 円）。"
+        )
 
 
 class OrderRefundPlugin:
     @kernel_function
-    def process_refund(self, order_id: str, reason: str) -> str:
+    async def process_refund(self, order_id: str, reason: str) -> str:
         """注文の返金処理を行います。"""
-        # 返金処理をシミュレート
-        print(f"注文 {order_id} の返金処理中 - 理由: {reason}")
-        return f"注文 {order_id} の返金処理が正常に完了しました。"
+        oid = parse_order_id(order_id)
+        try:
+            order = await order_repository.get_order(oid) if oid is not None else None
+        except DB_ERRORS as e:
+            print(f"注文 {order_id} の取得に失敗しました: {e}")
+            return f"注文 {order_id} の情報を現在取得できません。時間をおいて再度お試しください。"
+        if order is None:
+            return f"注文 {order_id} は見つからないため、返金処理できませんでした。"
+        print(f"注文 {oid} の返金処理中 - 理由: {reason}")
+        return f"注文 {oid} の返金処理（{order_total(order)} 円）が正常に完了しました。"
 
 
 class OrderReturnPlugin:
     @kernel_function
-    def process_return(self, order_id: str, reason: str) -> str:
+    async def process_return(self, order_id: str, reason: str) -> str:
         """注文の返品処理を行います。"""
-        # 返品処理をシミュレート
-        print(f"注文 {order_id} の返品処理中 - 理由: {reason}")
-        return f"注文 {order_id} の返品処理が正常に完了しました。"
+        oid = parse_order_id(order_id)
+        try:
+            order = await order_repository.get_order(oid) if oid is not None else None
+        except DB_ERRORS as e:
+            print(f"注文 {order_id} の取得に失敗しました: {e}")
+            return f"注文 {order_id} の情報を現在取得できません。時間をおいて再度お試しください。"
+        if order is None:
+            return f"注文 {order_id} は見つからないため、返品処理できませんでした。"
+        print(f"注文 {oid} の返品処理中 - 理由: {reason}")
+        return f"注文 {oid}（{format_items(order)}）の返品処理が正常に完了しました。"
 
 
 # Chat Completion API クライアントの初期化
@@ -167,18 +362,22 @@ async def main():
     runtime = InProcessRuntime()
     runtime.start()
 
-    # 5. タスクとランタイムでオーケストレーションを呼び出し
-    orchestration_result = await handoff_orchestration.invoke(
-        task="サポートを求めている顧客に挨拶してください。",
-        runtime=runtime,
-    )
+    try:
+        # 5. タスクとランタイムでオーケストレーションを呼び出し
+        orchestration_result = await handoff_orchestration.invoke(
+            task="サポートを求めている顧客に挨拶してください。",
+            runtime=runtime,
+        )
 
-    # 6. 結果を待機
-    value = await orchestration_result.get()
-    print(value)
+        # 6. 結果を待機
+        value = await orchestration_result.get()
+        print(value)
 
-    # 7. 呼び出し完了後にランタイムを停止
-    await runtime.stop_when_idle()
+        # 7. 呼び出し完了後にランタイムを停止
+        await runtime.stop_when_idle()
+    finally:
+        # エラー時も含めてコネクションプールを解放
+        await order_repository.close()
 
     """
     Sample output:
@@ -2,9 +2,14 @@ import os
 import json
 import asyncio
 import asyncpg
-from typing import Optional
+import threading
+import uvicorn
+import numpy as np
+from typing import List, Optional
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from fastmcp import FastMCP
 from azure.cosmos import CosmosClient
 
@@ -25,24 +30,111 @@ COSMOS_KEY = os.getenv("COSMOS_KEY")
 COSMOS_DB_NAME = os.getenv("COSMOS_DB", "twitterdb")
 COSMOS_CONTAINER_NAME = os.getenv("COSMOS_CONTAINER", "tweets")
 
+# ワーカー・コネクションプール設定
+# PostgreSQL の max_connections から管理用などの予約分を除いた数と、
+# Cosmos DB の RU 予算に合わせた同時クエリ数を、全ワーカーで分配します。
+PG_MAX_CONNECTIONS = int(os.getenv("PG_MAX_CONNECTIONS", 50))
+PG_RESERVED_CONNECTIONS = int(os.getenv("PG_RESERVED_CONNECTIONS", 10))
+PG_CONNECTION_BUDGET = PG_MAX_CONNECTIONS - PG_RESERVED_CONNECTIONS
+COSMOS_MAX_CONCURRENCY = int(os.getenv("COSMOS_MAX_CONCURRENCY", 8))
+if PG_CONNECTION_BUDGET < 1 or COSMOS_MAX_CONCURRENCY < 1:
+    raise ValueError(
+        "PG_MAX_CONNECTIONS - PG_RESERVED_CONNECTIONS と COSMOS_MAX_CONCURRENCY は 1 以上にしてください。"
+    )
+# MCP_WORKERS=1 の場合は従来どおり単一プロセスで起動。0 を指定すると CPU コア数で起動します。
+# ワーカーごとに最低 1 接続・1 スレッドを確保できるよう、ワーカー数は予算の範囲内に制限します。
+MCP_REQUESTED_WORKERS = int(os.getenv("MCP_WORKERS", 1)) or os.cpu_count() or 1
+MCP_WORKERS = min(MCP_REQUESTED_WORKERS, PG_CONNECTION_BUDGET, COSMOS_MAX_CONCURRENCY)
+MCP_HOST = os.getenv("MCP_HOST", "0.0.0.0")
+MCP_PORT = int(os.getenv("MCP_PORT", 8000))
+# シャットダウン時に処理中リクエストの完了を待つ秒数
+MCP_GRACEFUL_TIMEOUT = int(os.getenv("MCP_GRACEFUL_TIMEOUT", 30))
+# リクエストの待機後、コネクションプールを閉じる際に待つ秒数
+PG_POOL_CLOSE_TIMEOUT = float(os.getenv("PG_POOL_CLOSE_TIMEOUT", 5))
+PG_POOL_MAX_SIZE = min(int(os.getenv("PG_POOL_MAX_SIZE", 10)), PG_CONNECTION_BUDGET // MCP_WORKERS)
+# Cosmos DB の同時クエリ数（スレッドプールのサイズ）と、1 クエリあたりのタイムアウト秒数
+COSMOS_WORKER_THREADS = COSMOS_MAX_CONCURRENCY // MCP_WORKERS
+COSMOS_QUERY_TIMEOUT = int(os.getenv("COSMOS_QUERY_TIMEOUT", 30))
+
+# 配送見積もり設定
+PREFECTURE_LOCATIONS_PATH = os.getenv(
+    "PREFECTURE_LOCATIONS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sample_data", "prefecture_locations.json"),
+)
+FULFILLMENT_CENTERS = [
+    c.strip() for c in os.getenv("FULFILLMENT_CENTERS", "千葉県,大阪府,福岡県,北海道").split(",") if c.strip()
+]
+# 距離（km）の上限ごとの輸送日数。上限を超える場合は最後の日数 + 1 日
+TRANSIT_DAYS_BY_DISTANCE = [(150, 1), (600, 2), (1200, 3)]
+EARTH_RADIUS_KM = 6371.0
+
 # MCP サーバ定義
 mcp = FastMCP(
     name="Retail Shop + Twitter Analytics",
     instructions="PostgreSQLの各種マスター、注文、ユーザー情報と、CosmosDBに格納されたツイート分析データを、ツールとして提供します。"
 )
 
-# PostgreSQL 共通ヘルパ
+# PostgreSQL 共通ヘルパ（コネクションプールはワーカープロセスごとに作成）
+pg_pool: Optional[asyncpg.Pool] = None
+pg_pool_lock = asyncio.Lock()
+
+async def get_pool() -> asyncpg.Pool:
+    global pg_pool
+    if pg_pool is None:
+        async with pg_pool_lock:
+            if pg_pool is None:
+                pg_pool = await asyncpg.create_pool(min_size=1, max_size=PG_POOL_MAX_SIZE, **PG_CONFIG)
+    return pg_pool
+
+@asynccontextmanager
 async def get_conn():
-    return await asyncpg.connect(**PG_CONFIG)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        yield conn
 
 def to_json(data):
     return json.dumps(data, ensure_ascii=False, default=str)
 
-# CosmosDB 共通ヘルパ
+# CosmosDB 共通ヘルパ（同期 SDK の呼び出しはサイズ固定のスレッドプールで実行）
+cosmos_executor = ThreadPoolExecutor(max_workers=COSMOS_WORKER_THREADS, thread_name_prefix="cosmos")
+cosmos_container = None
+cosmos_container_lock = threading.Lock()
+
 def get_cosmos_container():
-    client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
-    db = client.get_database_client(COSMOS_DB_NAME)
-    return db.get_container_client(COSMOS_CONTAINER_NAME)
+    global cosmos_container
+    if cosmos_container is None:
+        # 複数のスレッドから同時に呼ばれてもクライアントは 1 つだけ作成
+        with cosmos_container_lock:
+            if cosmos_container is None:
+                client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY, connection_timeout=COSMOS_QUERY_TIMEOUT)
+                db = client.get_database_client(COSMOS_DB_NAME)
+                cosmos_container = db.get_container_client(COSMOS_CONTAINER_NAME)
+    return cosmos_container
+
+async def query_cosmos(query: str) -> list:
+    def run():
+        container = get_cosmos_container()
+        return list(container.query_items(
+            query, enable_cross_partition_query=True, timeout=COSMOS_QUERY_TIMEOUT
+        ))
+    return await asyncio.get_running_loop().run_in_executor(cosmos_executor, run)
+
+async def close_resources():
+    """コネクションプールとスレッドプールを解放します。
+
+    処理中リクエストの待機は uvicorn の graceful shutdown で済んでいるため、
+    ここではプールを短いタイムアウトで閉じ、待機中の Cosmos クエリを破棄します。
+    実行中の Cosmos クエリはスレッドを中断できないため、プロセス終了時に
+    最大 COSMOS_QUERY_TIMEOUT 秒程度その完了を待ちます。
+    """
+    global pg_pool
+    if pg_pool is not None:
+        try:
+            await asyncio.wait_for(pg_pool.close(), timeout=PG_POOL_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pg_pool.terminate()
+        pg_pool = None
+    cosmos_executor.shutdown(wait=False, cancel_futures=True)
 
 # --- PostgreSQL Tools ---
 @mcp.tool(
@@ -56,12 +148,9 @@ def get_cosmos_container():
     tags=["postgres"]
 )
 async def get_all_categories() -> str:
-    conn = await get_conn()
-    try:
+    async with get_conn() as conn:
         rows = await conn.fetch("SELECT * FROM categories")
         return to_json([dict(r) for r in rows])
-    finally:
-        await conn.close()
 
 @mcp.tool(
     name="get_all_users",
@@ -73,12 +162,9 @@ async def get_all_categories() -> str:
     """
 )
 async def get_all_users() -> str:
-    conn = await get_conn()
-    try:
+    async with get_conn() as conn:
         rows = await conn.fetch("SELECT * FROM users")
         return to_json([dict(r) for r in rows])
-    finally:
-        await conn.close()
 
 @mcp.tool(
     name="get_products_by_category",
@@ -93,14 +179,11 @@ async def get_all_users() -> str:
     """
 )
 async def get_products_by_category(category_id: int) -> str:
-    conn = await get_conn()
-    try:
+    async with get_conn() as conn:
         rows = await conn.fetch(
             "SELECT * FROM products WHERE category_id = $1", category_id
         )
         return to_json([dict(r) for r in rows])
-    finally:
-        await conn.close()
 
 @mcp.tool(
     name="get_orders_by_user",
@@ -115,12 +198,9 @@ async def get_products_by_category(category_id: int) -> str:
     """
 )
 async def get_orders_by_user(user_id: int) -> str:
-    conn = await get_conn()
-    try:
+    async with get_conn() as conn:
         rows = await conn.fetch("SELECT * FROM orders WHERE user_id = $1", user_id)
         return to_json([dict(r) for r in rows])
-    finally:
-        await conn.close()
 
 @mcp.tool(
     name="get_order_details",
@@ -135,12 +215,9 @@ async def get_orders_by_user(user_id: int) -> str:
     """
 )
 async def get_order_details(order_id: int) -> str:
-    conn = await get_conn()
-    try:
+    async with get_conn() as conn:
         rows = await conn.fetch("SELECT * FROM order_details WHERE order_id = $1", order_id)
         return to_json([dict(r) for r in rows])
-    finally:
-        await conn.close()
 
 @mcp.tool(
     name="get_sales_by_category",
@@ -159,8 +236,7 @@ async def get_sales_by_category(
     start_date: str,
     end_date: str
 ) -> str:
-    conn = await get_conn()
-    try:
+    async with get_conn() as conn:
         sql = """
             SELECT
                 c.category_id,
@@ -178,8 +254,6 @@ async def get_sales_by_category(
         """
         rows = await conn.fetch(sql, start_date, end_date)
         return to_json([dict(r) for r in rows])
-    finally:
-        await conn.close()
 
 @mcp.tool(
     name="get_sales_by_product",
@@ -198,8 +272,7 @@ async def get_sales_by_product(
     start_date: str,
     end_date: str
 ) -> str:
-    conn = await get_conn()
-    try:
+    async with get_conn() as conn:
         sql = """
             SELECT
                 p.product_id,
@@ -216,8 +289,116 @@ async def get_sales_by_product(
         """
         rows = await conn.fetch(sql, start_date, end_date)
         return to_json([dict(r) for r in rows])
-    finally:
-        await conn.close()
+
+
+# --- 配送見積もり Tools ---
+def haversine_matrix(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """緯度経度（度）の配列 src (n, 2), dst (m, 2) 間の距離行列 (n, m) を km で返します。"""
+    lat1, lon1 = np.radians(src[:, 0])[:, None], np.radians(src[:, 1])[:, None]
+    lat2, lon2 = np.radians(dst[:, 0])[None, :], np.radians(dst[:, 1])[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def load_prefecture_index(path: str, centers: List[str]):
+    """都道府県座標を読み込み、出荷拠点から各都道府県への距離と最寄り拠点を事前計算します。"""
+    with open(path, encoding="utf-8") as f:
+        locations = json.load(f)
+    names = list(locations)
+    coords = np.asarray([locations[n] for n in names], dtype=np.float64)
+    pref_index = {n: i for i, n in enumerate(names)}
+    unknown = [c for c in centers if c not in pref_index]
+    if unknown:
+        raise ValueError(f"FULFILLMENT_CENTERS に不明な都道府県が含まれています: {', '.join(unknown)}")
+    center_ids = np.asarray([pref_index[c] for c in centers], dtype=np.intp)
+    # (拠点数, 都道府県数) の距離行列と、都道府県ごとの最寄り拠点・距離
+    distances = haversine_matrix(coords[center_ids], coords).astype(np.float32)
+    nearest = distances.argmin(axis=0)
+    nearest_km = distances[nearest, np.arange(len(names))]
+    return names, pref_index, distances, nearest, nearest_km
+
+PREFECTURE_NAMES, PREFECTURE_INDEX, CENTER_DISTANCES, NEAREST_CENTER, NEAREST_CENTER_KM = load_prefecture_index(
+    PREFECTURE_LOCATIONS_PATH, FULFILLMENT_CENTERS
+)
+
+def find_prefecture(name: str) -> Optional[int]:
+    name = name.strip()
+    if name in PREFECTURE_INDEX:
+        return PREFECTURE_INDEX[name]
+    # 「東京」「大阪」など都道府県の接尾辞を省略した入力にも対応
+    for suffix in ("都", "道", "府", "県"):
+        if name + suffix in PREFECTURE_INDEX:
+            return PREFECTURE_INDEX[name + suffix]
+    return None
+
+def transit_days(distance_km: float) -> int:
+    for limit, days in TRANSIT_DAYS_BY_DISTANCE:
+        if distance_km <= limit:
+            return days
+    return TRANSIT_DAYS_BY_DISTANCE[-1][1] + 1
+
+@mcp.tool(
+    name="estimate_delivery",
+    description="""
+        お届け先の都道府県について、最寄りの出荷拠点からの距離と出荷予定日・到着予定日を見積もります。
+        商品IDを指定した場合は、在庫数もあわせて返します。
+
+        :param prefecture (str): お届け先の都道府県名（例: 東京都）
+        :param product_ids (list[int], Optional): 在庫を確認する商品IDのリスト
+        :param order_date (str, Optional): 注文日（YYYY-MM-DD）。未指定の場合は本日。
+        :rtype: str
+
+        :return: JSON形式で fulfillment_center, distance_km, ship_date, arrival_date, stock のリスト、
+            出荷日を確定できない原因の商品ID（unavailable_product_ids）などを返します。
+        :rtype: str
+    """,
+    tags=["postgres"]
+)
+async def estimate_delivery(
+    prefecture: str,
+    product_ids: Optional[List[int]] = None,
+    order_date: Optional[str] = None,
+) -> str:
+    pref_id = find_prefecture(prefecture)
+    if pref_id is None:
+        return to_json({"error": f"都道府県 '{prefecture}' が見つかりません。"})
+    try:
+        base_date = datetime.strptime(order_date, "%Y-%m-%d").date() if order_date else datetime.now().date()
+    except ValueError:
+        return to_json({"error": f"注文日 '{order_date}' は YYYY-MM-DD 形式で指定してください。"})
+    center = FULFILLMENT_CENTERS[NEAREST_CENTER[pref_id]]
+    distance_km = float(NEAREST_CENTER_KM[pref_id])
+
+    stock = []
+    if product_ids:
+        async with get_conn() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT p.product_id, p.product_name, COALESCE(i.stock, 0) AS stock
+                FROM products p
+                LEFT JOIN inventory i ON i.product_id = p.product_id
+                WHERE p.product_id = ANY($1::int[])
+                """,
+                product_ids,
+            )
+            stock = [dict(r) for r in rows]
+
+    # 翌日出荷。存在しない商品や在庫切れの商品がある場合は出荷日・到着日を返さない
+    found = {s["product_id"] for s in stock}
+    unavailable = sorted(
+        {pid for pid in (product_ids or []) if pid not in found}
+        | {s["product_id"] for s in stock if s["stock"] <= 0}
+    )
+    in_stock = not unavailable
+    ship_date = base_date + timedelta(days=1)
+    return to_json({
+        "prefecture": PREFECTURE_NAMES[pref_id],
+        "fulfillment_center": center,
+        "distance_km": round(distance_km, 1),
+        "ship_date": ship_date.isoformat() if in_stock else None,
+        "arrival_date": (ship_date + timedelta(days=transit_days(distance_km))).isoformat() if in_stock else None,
+        "stock": stock,
+        "unavailable_product_ids": unavailable,
+    })
 
 
 # --- CosmosDB Tools ---
@@ -234,9 +415,7 @@ async def get_sales_by_product(
     """
 )
 async def get_review_summary(product_id: Optional[int] = None) -> str:
-    container = get_cosmos_container()
-    query = "SELECT c.product_id, c.rating, c.recommend, c.tags FROM c"
-    items = list(container.query_items(query, enable_cross_partition_query=True))
+    items = await query_cosmos("SELECT c.product_id, c.rating, c.recommend, c.tags FROM c")
     # フィルタ
     if product_id is not None:
         items = [i for i in items if i.get("product_id") == product_id]
@@ -264,9 +443,7 @@ async def get_review_summary(product_id: Optional[int] = None) -> str:
     """
 )
 async def get_top_products_by_review() -> str:
-    container = get_cosmos_container()
-    query = "SELECT c.product_id, c.rating FROM c"
-    items = list(container.query_items(query, enable_cross_partition_query=True))
+    items = await query_cosmos("SELECT c.product_id, c.rating FROM c")
     # 商品ごとに集計
     from collections import defaultdict
     d = defaultdict(list)
@@ -294,9 +471,7 @@ async def get_top_products_by_review() -> str:
     """
 )
 async def get_trending_tags(top_n: int = 10) -> str:
-    container = get_cosmos_container()
-    query = "SELECT c.tags FROM c"
-    items = list(container.query_items(query, enable_cross_partition_query=True))
+    items = await query_cosmos("SELECT c.tags FROM c")
     from collections import Counter
     all_tags = []
     for i in items:
@@ -324,9 +499,7 @@ async def get_reviews_by_period_and_product(
     end_date: str,
     product_name: Optional[str] = None,
 ) -> str:
-    container = get_cosmos_container()
-    query = "SELECT c.product_id, c.product_name, c.review_date, c.rating, c.comment, c.user_id FROM c"
-    items = list(container.query_items(query, enable_cross_partition_query=True))
+    items = await query_cosmos("SELECT c.product_id, c.product_name, c.review_date, c.rating, c.comment, c.user_id FROM c")
     # フィルタ処理
     filtered = []
     for i in items:
@@ -353,5 +526,34 @@ async def get_reviews_by_period_and_product(
 
 
 # --- サーバ起動 ---
+# 複数ワーカーではリクエストごとに別プロセスへ振り分けられるため、セッションを持たない stateless モードで公開
+app = mcp.http_app(stateless_http=MCP_WORKERS > 1)
+mcp_lifespan = app.router.lifespan_context
+
+@asynccontextmanager
+async def worker_lifespan(app):
+    async with mcp_lifespan(app):
+        try:
+            yield
+        finally:
+            await close_resources()
+
+app.router.lifespan_context = worker_lifespan
+
 if __name__ == "__main__":
-    asyncio.run(mcp.run(transport="http", host="0.0.0.0", port=8000))
+    if MCP_WORKERS < MCP_REQUESTED_WORKERS:
+        print(
+            f"MCP_WORKERS={MCP_REQUESTED_WORKERS} は接続数・同時クエリ数の予算を超えるため、"
+            f"{MCP_WORKERS} ワーカーで起動します。"
+        )
+    if MCP_WORKERS > 1:
+        # 本番向け: 同一ポートで N ワーカープロセスを起動（SIGTERM で処理中リクエストを待ってから終了）
+        uvicorn.run(
+            "mcp_server:app",
+            host=MCP_HOST,
+            port=MCP_PORT,
+            workers=MCP_WORKERS,
+            timeout_graceful_shutdown=MCP_GRACEFUL_TIMEOUT,
+        )
+    else:
+        uvicorn.run(app, host=MCP_HOST, port=MCP_PORT, timeout_graceful_shutdown=MCP_GRACEFUL_TIMEOUT)